@@ -1,51 +1,201 @@
 import pandas as pd
+import codecs
+import urllib.error
+import urllib.parse
 import urllib.request
-from decimal import Decimal
 import json 
 import os 
+import re
+import ssl
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
+PRICE_JUNK = re.compile(r"[$,]") # currency symbols and thousands separators
+PADDED_CODE = re.compile(r"^0(?=.{5}$)") # a leading zero on a six character code
+SSL_CONTEXT = ssl.create_default_context() # load the CA bundle once and share it across downloads
+HOST_FAILURE_LIMIT = 2 # consecutive network failures on one server before the rest of its hospitals are skipped
+NETWORK_ERRORS = (urllib.error.URLError, TimeoutError, ConnectionError, ssl.SSLError, subprocess.CalledProcessError) # the server could not be reached or stopped answering
+TIMEOUT = 60 # seconds to wait on a server that has gone quiet
+MAX_DOWNLOAD_TIME = 1800 # seconds for a whole json download, the largest files take a few minutes
+CURL_HTTP_ERROR = 22 # curl --fail exit code for a 4xx/5xx response
+
 def cleanup_charges(charges: pd.DataFrame, rename: bool, gross: str, cash: str, cpt: str) -> pd.DataFrame:
     """standarize the cleaning into a normalized table of prices"""
     if rename:
         charges["gross"] = charges[gross]
         charges["cash"] = charges[cash]        
-        charges["concept_code"] = charges[[cpt]]
-        charges["concept_code"] = charges["concept_code"].apply(lambda x: strip_zero(x.strip()))
+        charges["concept_code"] = strip_zero(charges[cpt].str.strip())
         charges["vocabulary_id"] = "cpt"
 
-    if charges.gross.dtype != 'float64':
-        charges["gross"] = charges[["gross"]].apply(lambda x: x.str.replace(",","").str.replace("$",""))
-        charges["gross"] = charges["gross"].apply(pd.to_numeric, errors='ignore', downcast='float')
-    if charges.cash.dtype != 'float64':
-        charges["cash"] = charges[["cash"]].apply(lambda x: x.str.replace(",","").str.replace("$",""))
-        charges["cash"] = charges["cash"].apply(pd.to_numeric, errors='ignore', downcast='float')
+    # narrow to known cpt codes first so prices are only cleaned for rows we keep
+    charges = charges[charges.vocabulary_id == "cpt"]
+    charges = charges[charges.concept_code.isin(cpt_codes)].copy()
 
+    if not pd.api.types.is_numeric_dtype(charges.gross):
+        charges["gross"] = charges["gross"].astype(str).str.replace(PRICE_JUNK, "", regex=True)
+        charges["gross"] = pd.to_numeric(charges["gross"], errors='coerce')
+    if not pd.api.types.is_numeric_dtype(charges.cash):
+        charges["cash"] = charges["cash"].astype(str).str.replace(PRICE_JUNK, "", regex=True)
+        charges["cash"] = pd.to_numeric(charges["cash"], errors='coerce')
+    charges[["cash","gross"]] = charges[["cash","gross"]].astype("float64") # keep whole-dollar prices as 5.0 in the output
 
-    charges = charges[charges.vocabulary_id == "cpt"]
-    charges = pd.merge(charges,concept[["concept_code"]],left_on="concept_code",right_on="concept_code")
     charges = charges.groupby(["vocabulary_id","concept_code"])[["cash","gross"]].max().reset_index()
     charges = pd.melt(charges,id_vars="concept_code",value_vars=["cash","gross"])
     charges = charges.rename(columns={"concept_code":"cpt","variable":"type","value":"price"})
-    charges = charges.drop_duplicates().dropna().round(2).sort_values(["cpt","type"])
+    charges = charges.dropna().round(2).sort_values(["cpt","type"])
+    return charges
+
+
+def load_csv(url: str, skiprows: int, usecols: list) -> pd.DataFrame:
+    """broken links often serve an html error page, so check before reading the whole body"""
+    request = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})
+    with urllib.request.urlopen(request, timeout=TIMEOUT, context=SSL_CONTEXT) as f:
+        if f.headers.get_content_type() == "text/html":
+            raise ValueError("expected a csv but got html from " + url)
+        compression = "gzip" if f.headers.get("Content-Encoding") == "gzip" else None
+        encoding = known_encoding(f.headers.get_content_charset("utf-8")) # trust the declared charset rather than guessing
+        # most hosts never declare one, codes and prices are ascii so stray bytes in descriptions are harmless
+        charges = pd.read_csv(f,skiprows=skiprows,usecols=usecols,compression=compression,encoding=encoding,encoding_errors="replace",dtype="object",keep_default_na=False)
     return charges
 
+def known_encoding(charset: str) -> str:
+    """servers sometimes declare charsets python has never heard of, like mysql's utf8mb4"""
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return "utf-8"
 
 def load_json(url: str) -> dict:
     """requests gets a 403 forbidden a lot, so just use curl"""
-    os.system('curl ' + url + " | jq > tmp.json")
-    with open("tmp.json","r") as f:
-        charges = json.load(f)
-    if os.path.exists("tmp.json"):
-        os.remove("tmp.json")                
-    return charges
+    command = ["curl", "-s", "--fail", "--compressed", "--retry", "3", "--connect-timeout", str(TIMEOUT), "--max-time", str(MAX_DOWNLOAD_TIME), url]
+    body = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(body)
 
-def strip_zero(string: str) -> str:
+def strip_zero(codes: pd.Series) -> pd.Series:
     """some unfortunate individuals pad their cpt codes with zeros"""
-    if len(string) == 6 and string[0] == "0":
-        return string[1:]
-    else: 
-        return string
+    return codes.str.replace(PADDED_CODE, "", regex=True)
+
+
+def parse_csv(row: pd.Series) -> pd.DataFrame:
+    """flat csv files with the column names configured in the hospital dimension"""
+    # payer-specific rates make these files wide, only keep the columns we normalize
+    charges = load_csv(row["file_url"], int(row["skiprow"]), [row["cpt"], row["gross"], row["cash"]])
+    return cleanup_charges(
+        charges = charges,
+        rename = True,
+        gross = row["gross"],
+        cash = row["cash"],
+        cpt = row["cpt"]
+    )
+
+def parse_advent(row: pd.Series) -> pd.DataFrame:
+    """advent nests the list of charges one level down"""
+    charges = load_json(row["file_url"])
+    code_type = ['cpt' if 'CPT' in x['Code Type'] else 'ot' for x in charges[0]]
+    code = [x['Code'] for x in charges[0]]
+    gross = [x['Gross Charge'] for x in charges[0]]
+    cash = [x['Discounted Cash Price'] for x in charges[0]]
+    charges = pd.DataFrame({"vocabulary_id": code_type, "concept_code": code, "gross": gross, "cash": cash})
+    charges["vocabulary_id"] = charges["vocabulary_id"].str.lower()
+    return cleanup_charges(
+        charges = charges,
+        rename = False,
+        cash = "cash",
+        gross = "gross",
+        cpt = "cpt"
+    )
+
+def parse_memorial(row: pd.Series) -> pd.DataFrame:
+    """memorial follows the cms json template"""
+    charges = load_json(row["file_url"])
+    charges = charges["standard_charge_information"]
+    code_type = [x['billing_code_information'][0]['type'] for x in charges]
+    code = [x['billing_code_information'][0]['code'] for x in charges]
+    standard = [x['standard_charges'][0] for x in charges]
+    gross = [x.get('gross_charge') for x in standard]
+    cash = [x.get('discounted_cash') for x in standard]
+    charges = pd.DataFrame({"vocabulary_id": code_type, "concept_code": code, "gross": gross, "cash": cash})
+    charges["vocabulary_id"] = charges["vocabulary_id"].str.lower()
+    return cleanup_charges(
+        charges = charges,
+        rename = False,
+        cash = "cash",
+        gross = "gross",
+        cpt = "cpt"
+    )
+
+def parse_covenant(row: pd.Series) -> pd.DataFrame:
+    """covenant wraps each charge in a list and leads with a header record"""
+    charges = load_json(row["file_url"])
+    charges = charges['data']
+    del charges[0]
+    code_type = [x[0]['code type'] for x in charges]
+    code = [x[0]['code'] for x in charges]
+    gross = [x[0]['gross charge'] for x in charges]
+    cash = [x[0]['discounted cash price'] for x in charges]
+    charges = pd.DataFrame({"vocabulary_id": code_type, "concept_code": code, "gross": gross, "cash": cash})
+    return cleanup_charges(
+        charges = charges,
+        rename = False,
+        gross = "gross",
+        cash = "cash",
+        cpt = "cpt"
+    )
+
+# one parser per (idn, type) so each hospital is routed with a single lookup
+PARSERS = {
+    ("Parkridge", "CSV"): parse_csv,
+    ("Mission Health", "CSV"): parse_csv,
+    ("Tennova Healthcare", "CSV"): parse_csv,
+    ("Advent Health", "JSON"): parse_advent,
+    ("Memorial", "JSON"): parse_memorial,
+    ("Covenant Health", "JSON"): parse_covenant,
+}
+
+def scrape_hospital(row: pd.Series) -> tuple:
+    """download and normalize a single hospital into its jsonl file, report how it went and whether the server was unreachable"""
+    outfile = "./data/" + str(row["hospital_npi"]) + ".jsonl"
+
+    try:
+        parser = PARSERS.get((row["idn"], row["type"]))
+        if parser is not None:
+            parser(row).to_json(outfile,lines=True,orient="records")
+        result = "SUCCESS" if os.path.exists(outfile) else "WIP"
+    except urllib.error.HTTPError:
+        result = "FAILURE" # the server answered, the file is just missing or forbidden
+    except NETWORK_ERRORS as error:
+        # curl reports an http error status the same way urlopen raises HTTPError, the server is still up
+        if isinstance(error, subprocess.CalledProcessError) and error.returncode == CURL_HTTP_ERROR:
+            return status_record(row, "FAILURE"), False
+        return status_record(row, "FAILURE"), True
+    except Exception:
+        result = "FAILURE"
+
+    return status_record(row, result), False
+
+def scrape_host(rows: list) -> list:
+    """hospitals in the same system share a server, so fetch them one at a time to avoid getting throttled"""
+    status = []
+    failures = 0
+    for row in rows:
+        # a server that keeps dropping connections is down for the day, skip the rest of its hospitals
+        if failures >= HOST_FAILURE_LIMIT:
+            status.append(status_record(row, "SKIPPED"))
+            continue
+        record, unreachable = scrape_hospital(row)
+        failures = failures + 1 if unreachable else 0
+        status.append(record)
+    return status
+
+def status_record(row: pd.Series, result: str) -> dict:
+    """one line of status.csv"""
+    return {
+        "date": today,
+        "hospital_npi": row["hospital_npi"],
+        "status": result,
+        "file_url": row["file_url"]
+    }
 
 
 # hospital dimension
@@ -55,135 +205,19 @@ dt = dt[dt.can_automate == True] # only include those that are working based on
 # concept dimension from OHDSI athena
 concept = pd.read_csv("./dim/CONCEPT.csv.gz",compression='gzip',sep="\t")
 concept = concept[(concept.vocabulary_id=='CPT4')] # there are technically overlaps in this code set, improve in the future
+cpt_codes = frozenset(concept.concept_code) # membership lookup for cleanup_charges
 
 # status 
-status = []
+today = str(date.today())
 
+# group hospitals by the server that hosts their file
+hosts = {}
 for index, row in dt.iterrows():
+    hosts.setdefault(urllib.parse.urlparse(row["file_url"]).netloc, []).append(row)
 
-    try:
-
-        if row["idn"] == "Parkridge":
-            with urllib.request.urlopen(row["file_url"]) as f:
-                charges = pd.read_csv(f,skiprows=int(row["skiprow"]),dtype="object",keep_default_na=False) 
-            charges = cleanup_charges(
-                charges = charges,
-                rename = True,
-                gross = row["gross"],
-                cash = row["cash"],
-                cpt = row["cpt"]
-            )
-            charges.to_json("./data/" + str(row["hospital_npi"]) + ".jsonl",lines=True,orient="records") 
-
-
-        if row["idn"] == "Mission Health":
-            with urllib.request.urlopen(row["file_url"]) as f:
-                charges = pd.read_csv(f,skiprows=int(row["skiprow"]),dtype="object",keep_default_na=False) 
-            charges = cleanup_charges(
-                charges = charges,
-                rename = True,
-                gross = row["gross"],
-                cash = row["cash"],
-                cpt = row["cpt"]
-            )
-            charges.to_json("./data/" + str(row["hospital_npi"]) + ".jsonl",lines=True,orient="records") 
-            
-
-        if row["idn"] == "Advent Health":
-            charges = load_json(row["file_url"])
-            code_type = ['cpt' if 'CPT' in x['Code Type'] else 'ot' for x in charges[0]]
-            cpt = [x['Code'] for x in charges[0]]
-            gross = [x['Gross Charge'] for x in charges[0]]
-            cash = [x['Discounted Cash Price'] for x in charges[0]]
-            charges = pd.DataFrame(list(zip(code_type,code,gross,cash)))    
-            charges.columns = ['vocabulary_id','concept_code','gross','cash']
-            charges["vocabulary_id"] = charges["vocabulary_id"].str.lower()
-            charges = cleanup_charges(
-                charges = charges,
-                rename = False,
-                cash = "cash",
-                gross = "gross",
-                cpt = "cpt"
-            )
-            charges.to_json("./data/" + str(row["hospital_npi"]) + ".jsonl",lines=True,orient="records") 
-
-        if row["idn"] == "Memorial":
-            charges = load_json(row["file_url"])
-            charges = charges["standard_charge_information"]         
-            code_type = [x['billing_code_information'][0]['type'] for x in charges]
-            cpt = [x['billing_code_information'][0]['code'] for x in charges]
-            gross = [x['gross_charge'] if 'gross_charge' in x.keys() else None for x in [x['standard_charges'][0] for x in charges]]
-            cash = [x['discounted_cash'] if 'discounted_cash' in x.keys() else None for x in [x['standard_charges'][0] for x in charges]]
-            charges = pd.DataFrame(list(zip(code_type,code,gross,cash)))    
-            charges.columns = ['vocabulary_id','concept_code','gross','cash']
-            charges["vocabulary_id"] = charges["vocabulary_id"].str.lower()
-            charges = cleanup_charges(
-                charges = charges,
-                rename = False,
-                cash = "cash",
-                gross = "gross",
-                cpt = "cpt"
-            )
-            charges.to_json("./data/" + str(row["hospital_npi"]) + ".jsonl",lines=True,orient="records") 
-
-        if row["idn"] == "Tennova Healthcare":
-            if row["type"] == "CSV":
-                with urllib.request.urlopen(row["file_url"]) as f:
-                    charges = pd.read_csv(f,skiprows=int(row["skiprow"]),dtype="object",keep_default_na=False) 
-                charges = cleanup_charges(
-                    charges = charges,
-                    rename = True,
-                    gross = row["gross"],
-                    cash = row["cash"],
-                    cpt = row["cpt"]
-                )
-                charges.to_json("./data/" + str(row["hospital_npi"]) + ".jsonl",lines=True,orient="records") 
-
-        if row["idn"] == 'Covenant Health':
-            if row["type"] == "JSON":
-                os.system('curl ' + row["file_url"] + " | jq > tmp.json")
-                with open("tmp.json","r") as f:
-                    charges = json.load(f)
-                if os.path.exists("tmp.json"):
-                    os.remove("tmp.json")                
-                charges = charges['data']
-                del charges[0]
-                code_type = [x[0]['code type'] for x in charges]
-                code = [x[0]['code'] for x in charges]
-                gross = [x[0]['gross charge'] for x in charges]
-                cash = [x[0]['discounted cash price'] for x in charges]
-                charges = pd.DataFrame(list(zip(code_type,code,gross,cash)))    
-                charges.columns = ['vocabulary_id','concept_code','gross','cash']
-                charges = cleanup_charges(
-                    charges = charges,
-                    rename = False,
-                    gross = "gross",
-                    cash = "cash",
-                    cpt = "cpt"
-                )
-                charges.to_json("./data/" + str(row["hospital_npi"]) + ".jsonl",lines=True,orient="records") 
-
-        if os.path.exists("./data/" + str(row["hospital_npi"]) + ".jsonl"):
-            status.append({
-                "date": str(date.today()),
-                "hospital_npi": row["hospital_npi"],
-                "status": "SUCCESS",
-                "file_url": row["file_url"]            
-            })                
-        else:
-            status.append({
-                "date": str(date.today()),
-                "hospital_npi": row["hospital_npi"],
-                "status": "WIP",
-                "file_url": row["file_url"]            
-            })
-    except:
-        status.append({
-           "date": str(date.today()),
-           "hospital_npi": row["hospital_npi"],
-           "status": "FAILURE",
-           "file_url": row["file_url"]            
-       })
+# servers are independent and mostly waiting on the network, so overlap the downloads
+with ThreadPoolExecutor(max_workers=4) as pool:
+    status = [record for records in pool.map(scrape_host, hosts.values()) for record in records]
 
 
 pd.DataFrame(status).sort_values(['hospital_npi']).to_csv("status.csv",index=False)